@@ -1,92 +1,133 @@
-import os
 import sys
-import io
+import math
 import datetime as dt
-import xml.etree.ElementTree as ET
 from typing import List, Dict
 
+import numpy as np
 import pandas as pd
-import requests
+from lxml import etree
+
+from etl_common import (
+    ECB_CUBE_TAG,
+    HIST_PLN,
+    HIST_RAW,
+    TARGETS,
+    compute_pln_rates,
+    ensure_dirs,
+    load_history,
+    open_xml_stream,
+    save_outputs,
+)
 
 # --- Stałe / Ścieżki ---
 ECB_90D_XML_URL = "https://www.ecb.europa.eu/stats/eurofxref/eurofxref-hist-90d.xml"
 
-DATA_DIR = "data"
-HIST_RAW = os.path.join(DATA_DIR, "history_eur_base.csv")   # 1 EUR = X [waluta]
-HIST_PLN = os.path.join(DATA_DIR, "history_pln.csv")
-
-TARGETS: List[str] = ["EUR", "USD", "GBP", "CHF"]
-
-# --- Utils ---
-def ensure_dirs():
-    os.makedirs(DATA_DIR, exist_ok=True)
-
-def load_history(path: str) -> pd.DataFrame:
-    if os.path.exists(path):
-        df = pd.read_csv(path, parse_dates=["date"])
-        df.columns = [c.upper() if c != "date" else "date" for c in df.columns]
-        return df.sort_values("date")
-    return pd.DataFrame(columns=["date"]).astype({"date": "datetime64[ns]"})
-
-def save_history(path: str, df: pd.DataFrame) -> None:
-    df.sort_values("date").to_csv(path, index=False)
-
-def compute_pln_rates(df: pd.DataFrame, targets: List[str]) -> pd.DataFrame:
-    if "PLN" not in df.columns:
-        raise ValueError("Brak kolumny 'PLN' w danych ECB – nie policzymy kursów do PLN.")
-    out = pd.DataFrame({"date": df["date"]})
-    if "EUR" in targets:
-        out["EUR_PLN"] = df["PLN"]
-    for ccy in targets:
-        if ccy in ("EUR",):
-            continue
-        if ccy not in df.columns:
-            continue
-        out[f"{ccy}_PLN"] = df["PLN"] / df[ccy]
-    return out.dropna(how="all", subset=[c for c in out.columns if c != "date"]).sort_values("date")
-
 # --- Parsowanie XML 90 dni ---
 def fetch_ecb_90d_xml(url: str = ECB_90D_XML_URL, timeout: int = 30) -> pd.DataFrame:
-    r = requests.get(url, timeout=timeout)
-    r.raise_for_status()
-    tree = ET.parse(io.BytesIO(r.content))
-    root = tree.getroot()
-    ns_strip = lambda tag: tag.split("}")[-1]
-
-    records = []
-    for cube_time in root.iter():
-        if ns_strip(cube_time.tag) == "Cube" and "time" in cube_time.attrib:
-            date_str = cube_time.attrib["time"]
-            rates: Dict[str, float] = {}
-            for n in cube_time:
-                if ns_strip(n.tag) == "Cube" and "currency" in n.attrib and "rate" in n.attrib:
-                    ccy = n.attrib["currency"].upper()
-                    try:
-                        rates[ccy] = float(n.attrib["rate"])
-                    except ValueError:
-                        rates[ccy] = float("nan")
-            rec = {"date": pd.to_datetime(date_str, format="%Y-%m-%d")}
-            rec.update(rates)
-            records.append(rec)
-
-    df = pd.DataFrame(records)
-    # kolumny na upper
-    df.columns = [c.upper() if c != "date" else "date" for c in df.columns]
-    df = df.sort_values("date").drop_duplicates(subset=["date"], keep="last")
+    # iterparse z filtrem na "Cube" parsuje strumieniowo w C (libxml2),
+    # prosto z gniazda (parsowanie nakłada się na pobieranie), bez budowania
+    # pełnego drzewa (~90 dni × ~30 walut) w pamięci.
+    # Akumulujemy kolumnowo (lista na walutę) zamiast wiersz-po-wierszu
+    # jako listę słowników — pd.DataFrame dostaje gotowe kolumny i nie
+    # musi scalać kluczy ani boxować brakujących komórek per wiersz.
+    dates: List[str] = []
+    cols: Dict[str, List[float]] = {}
+
+    # resolve_entities=False: nie rozwijamy encji z zewnętrznego XML
+    # (odpowiednik defusedxml dla lxml)
+    with open_xml_stream(url, "hist90", timeout=timeout) as stream:
+        for _event, elem in etree.iterparse(
+            stream, tag=ECB_CUBE_TAG, events=("start",), resolve_entities=False
+        ):
+            time_attr = elem.get("time")
+            ccy = elem.get("currency")
+            if time_attr is not None:
+                # nowy dzień — nowy wiersz
+                dates.append(time_attr)
+            elif ccy is not None and elem.get("rate") is not None:
+                ccy = ccy.upper()
+                col = cols.get(ccy)
+                if col is None:
+                    # waluta pojawia się pierwszy raz — uzupełnij wstecz NaN-ami
+                    col = cols[ccy] = [math.nan] * (len(dates) - 1)
+                # waluta mogła nie wystąpić w części poprzednich dni
+                if len(col) < len(dates) - 1:
+                    col.extend([math.nan] * (len(dates) - 1 - len(col)))
+                try:
+                    col.append(float(elem.get("rate")))
+                except ValueError:
+                    col.append(math.nan)
+            # sprzątanie przetworzonych elementów — pamięć pozostaje płaska
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+    # dalej już czyste numpy: dopełnienie, sort i dedup na gotowych
+    # tablicach; DataFrame powstaje dopiero na granicy (merge/zapis),
+    # bez przechodzenia przez Block managera pandas w gorącej ścieżce
+    n_rows = len(dates)
+    date_arr = pd.to_datetime(dates, format="%Y-%m-%d", cache=True).to_numpy()
+    arrays: Dict[str, np.ndarray] = {}
+    for ccy, col in cols.items():
+        if len(col) < n_rows:
+            col.extend([math.nan] * (n_rows - len(col)))
+        # float32 wystarcza na ≤6 cyfr znaczących ECB, a o połowę mniej
+        # bajtów płynie przez dalsze operacje kolumnowe
+        arrays[ccy] = np.asarray(col, dtype=np.float32)
+
+    # stabilny sort po dacie + "ostatni wygrywa" przy zdublowanych datach
+    order = np.argsort(date_arr, kind="stable")
+    sorted_dates = date_arr[order]
+    keep = np.ones(n_rows, dtype=bool)
+    if n_rows:
+        keep[:-1] = sorted_dates[:-1] != sorted_dates[1:]
+    sel = order[keep]
+
+    df = pd.DataFrame({ccy: arr[sel] for ccy, arr in arrays.items()})
+    df.insert(0, "date", sorted_dates[keep])
     return df
 
 # --- Merge z historią ---
 def upsert_90d_into_history(hist: pd.DataFrame, last90: pd.DataFrame) -> pd.DataFrame:
     if hist.empty:
         return last90.copy()
-    hist_idx = hist.set_index("date")
-    last90_idx = last90.set_index("date")
-    hist_idx.update(last90_idx)
-    missing_idx = last90_idx.index.difference(hist_idx.index)
-    if len(missing_idx) > 0:
-        hist_idx = pd.concat([hist_idx, last90_idx.loc[missing_idx]], axis=0)
-    hist_idx = hist_idx.sort_index()
-    return hist_idx.reset_index()
+
+    # obie ramki są posortowane po dacie, więc upsert to scalenie dwóch
+    # posortowanych ciągów: union1d + searchsorted dają pozycje w O(N+M)
+    # zamiast ogólnego hash-joina pandas
+    h_dates = hist["date"].to_numpy()
+    l_dates = last90["date"].to_numpy()
+    # odpowiednik validate="one_to_one": ściśle rosnące = bez duplikatów
+    if (len(h_dates) > 1 and not (h_dates[1:] > h_dates[:-1]).all()) or \
+       (len(l_dates) > 1 and not (l_dates[1:] > l_dates[:-1]).all()):
+        raise ValueError("Zduplikowane daty w historii lub w oknie 90 dni.")
+
+    merged_dates = np.union1d(h_dates, l_dates)
+    pos_h = merged_dates.searchsorted(h_dates)
+    pos_l = merged_dates.searchsorted(l_dates)
+    n = len(merged_dates)
+
+    arrays: Dict[str, np.ndarray] = {}
+    for col in hist.columns:
+        if col == "date":
+            continue
+        out = np.full(n, np.nan, dtype=np.float32)
+        out[pos_h] = hist[col].to_numpy()
+        arrays[col] = out
+    for col in last90.columns:
+        if col == "date":
+            continue
+        out = arrays.get(col)
+        if out is None:
+            out = arrays[col] = np.full(n, np.nan, dtype=np.float32)
+        new_vals = last90[col].to_numpy()
+        # świeższe dane wygrywają, ale NaN nie nadpisuje starej wartości
+        has_val = ~np.isnan(new_vals)
+        out[pos_l[has_val]] = new_vals[has_val]
+
+    merged = pd.DataFrame(arrays)
+    merged.insert(0, "date", merged_dates)
+    return merged
 
 def main():
     try:
@@ -104,11 +145,11 @@ def main():
         after_rows = len(merged)
         print(f"Historia po scaleniu: {after_rows} wierszy (wcześniej: {before_rows}).")
 
-        save_history(HIST_RAW, merged)
-        print(f"Zapisano: {HIST_RAW}")
-
         df_pln = compute_pln_rates(merged, TARGETS)
-        df_pln.to_csv(HIST_PLN, index=False)
+        # przepisz tylko partycje lat objętych oknem 90 dni; oba zapisy
+        # jednym krokiem, równolegle
+        save_outputs(merged, df_pln, years=[int(y) for y in last90["date"].dt.year.unique()])
+        print(f"Zapisano: {HIST_RAW}")
         print(f"Zapisano: {HIST_PLN}")
 
         print("Backfill 90 dni zakończony.")
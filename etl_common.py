@@ -0,0 +1,272 @@
+"""Wspólne narzędzia dla main.py i backfill_90d.py (HTTP do ECB, ścieżki, historia)."""
+import glob
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import List
+
+import httpx
+import numpy as np
+import pandas as pd
+
+# --- Stałe / Ścieżki ---
+DATA_DIR = "data"
+CACHE_DIR = os.path.join(DATA_DIR, ".ecb_cache")
+
+# Historia trzymana w Parquet (typowane kolumny binarnie, bez re-parsowania
+# tekstu i dat przy każdym biegu); stare pliki .csv czytamy dalej.
+# Surowa historia jest partycjonowana po roku (data/history_eur_base/year=YYYY/
+# part.parquet) — zapis dotyka tylko zmienionych lat zamiast przepisywać
+# całość przy każdym biegu.
+HIST_RAW = os.path.join(DATA_DIR, "history_eur_base")          # 1 EUR = X [waluta]
+HIST_PLN = os.path.join(DATA_DIR, "history_pln.parquet")       # historia przeliczona do PLN
+
+# Waluty, które pokażemy w PLN (EUR to po prostu kolumna PLN)
+TARGETS: List[str] = ["EUR", "USD", "GBP", "CHF"]
+
+# Namespace ECB jest stabilny — pełny tag raz na moduł zamiast składania
+# / porównywania stringów w pętli parsera
+ECB_CUBE_TAG = "{http://www.ecb.int/vocabulary/2002-08-01/eurofxref}Cube"
+
+# Jeden klient na proces: keepalive + HTTP/2 po ALPN — wznawiana sesja TLS
+# i multipleksowane żądania przy kilku wywołaniach do ECB w jednym biegu.
+_CLIENT = httpx.Client(http2=True, follow_redirects=True)
+
+
+def ensure_dirs():
+    os.makedirs(DATA_DIR, exist_ok=True)
+
+
+def _partition_path(base: str, year: int) -> str:
+    return os.path.join(base, f"year={year}", "part.parquet")
+
+
+def _empty_history() -> pd.DataFrame:
+    return pd.DataFrame(columns=["date"]).astype({"date": "datetime64[ns]"})
+
+
+def _normalize_history(df: pd.DataFrame, rename: bool = True) -> pd.DataFrame:
+    if rename:
+        # normalizacja nazw walut (upper) — tylko dla plików spoza potoku;
+        # parser uppercase'uje kody już przy budowaniu kolumn
+        df.rename(columns=lambda c: c if c == "date" else c.upper(), inplace=True)
+    # starsze pliki mogą mieć float64 — sprowadź do float32 jak reszta potoku
+    float_cols = df.columns.difference(["date"])
+    df[float_cols] = df[float_cols].astype("float32", copy=False)
+    # historia jest zapisywana posortowana — sortuj tylko, gdy faktycznie trzeba
+    if not df["date"].is_monotonic_increasing:
+        df = df.sort_values("date", ignore_index=True)
+    return df
+
+
+def load_history(path: str) -> pd.DataFrame:
+    # ścieżka bez rozszerzenia = katalog partycjonowany po roku
+    if not os.path.splitext(path)[1]:
+        parts = sorted(glob.glob(os.path.join(path, "year=*", "part.parquet")))
+        if parts:
+            # partycje pisze wyłącznie ten potok — nazwy są już znormalizowane
+            df = pd.concat([pd.read_parquet(p) for p in parts], ignore_index=True)
+            return _normalize_history(df, rename=False)
+        # migracja: historia zapisana jeszcze jako pojedynczy plik
+        for legacy in (path + ".parquet", path + ".csv"):
+            if os.path.exists(legacy):
+                path = legacy
+                break
+        else:
+            return _empty_history()
+    if not os.path.exists(path):
+        # migracja: historia zapisana jeszcze jako CSV przez starszą wersję
+        legacy_csv = os.path.splitext(path)[0] + ".csv"
+        if path.endswith(".parquet") and os.path.exists(legacy_csv):
+            path = legacy_csv
+        else:
+            return _empty_history()
+    if path.endswith(".csv"):
+        # wielowątkowy czytnik CSV Arrow zamiast domyślnego silnika C;
+        # daty ISO parsują się natywnie, bez pythonowego fallbacku
+        df = pd.read_csv(path, engine="pyarrow", parse_dates=["date"])
+    else:
+        df = pd.read_parquet(path)
+    return _normalize_history(df)
+
+
+def save_history(path: str, df: pd.DataFrame, years: List[int] | None = None) -> None:
+    """
+    Zapisuje historię. Dla ścieżki partycjonowanej (bez rozszerzenia) przepisuje
+    tylko partycje z `years` (oraz te, których jeszcze nie ma na dysku) —
+    zapis rośnie z liczbą nowych wierszy, nie z długością całej historii.
+    `years=None` przepisuje wszystko.
+    """
+    # dane przychodzą posortowane z load/upsert — nie sortuj drugi raz
+    if not df["date"].is_monotonic_increasing:
+        df = df.sort_values("date", ignore_index=True)
+    if path.endswith(".csv"):
+        df.to_csv(path, index=False)
+        return
+    if not os.path.splitext(path)[1]:
+        for year, sub in df.groupby(df["date"].dt.year):
+            part = _partition_path(path, int(year))
+            if years is not None and int(year) not in years and os.path.exists(part):
+                continue  # rok nietknięty w tym biegu
+            os.makedirs(os.path.dirname(part), exist_ok=True)
+            sub.to_parquet(part, compression="zstd", index=False)
+        if os.environ.get("FX_EXPORT_CSV"):
+            df.to_csv(path + ".csv", index=False)
+        return
+    df.to_parquet(path, compression="zstd", index=False)
+    # opcjonalny eksport CSV (np. do ręcznego podglądu)
+    if os.environ.get("FX_EXPORT_CSV"):
+        df.to_csv(os.path.splitext(path)[0] + ".csv", index=False)
+
+
+def save_outputs(hist: pd.DataFrame, df_pln: pd.DataFrame,
+                 years: List[int] | None = None) -> None:
+    """
+    Zapisuje surową historię i przeliczenia PLN w jednym kroku, na świeżo
+    policzonych kolumnach, póki siedzą w cache. Oba zapisy to niezależne
+    I/O (parquet zwalnia GIL), więc idą równolegle.
+    """
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        f_raw = pool.submit(save_history, HIST_RAW, hist, years)
+        f_pln = pool.submit(save_history, HIST_PLN, df_pln)
+        f_raw.result()
+        f_pln.result()
+
+
+# plan przeliczenia (kolumny wejściowe/wyjściowe) zależy tylko od TARGETS
+# i schematu danych — liczymy go raz i zapamiętujemy zamiast odtwarzać
+# listy i f-stringi przy każdym wywołaniu
+_PLN_PLAN_CACHE: dict = {}
+
+
+def _pln_plan(targets: List[str], columns) -> tuple:
+    key = (tuple(targets), tuple(columns))
+    plan = _PLN_PLAN_CACHE.get(key)
+    if plan is None:
+        cols = [c for c in targets if c != "EUR" and c in columns]
+        plan = _PLN_PLAN_CACHE[key] = (cols, [f"{c}_PLN" for c in cols], "EUR" in targets)
+    return plan
+
+
+def compute_pln_rates(df: pd.DataFrame, targets: List[str]) -> pd.DataFrame:
+    """
+    Z danych ECB (1 EUR = X [ccy]) tworzy tabelę kursów w PLN dla wybranych walut.
+    EUR->PLN = kolumna PLN (bo 1 EUR = X PLN).
+    USD->PLN = PLN / USD, itd.
+    """
+    if "PLN" not in df.columns:
+        raise ValueError("W danych ECB brak kolumny 'PLN' — nie policzymy przeliczeń do PLN.")
+
+    cols, out_names, with_eur = _pln_plan(targets, df.columns)
+    pln = df["PLN"].to_numpy()
+    # jedno rozgłoszone dzielenie (N, C) zamiast osobnej operacji Series
+    # per waluta z własnym wyrównywaniem indeksu
+    rates = pln[:, None] / df[cols].to_numpy()
+
+    arrays = {}
+    if with_eur:
+        arrays["EUR_PLN"] = pln
+    for i, name in enumerate(out_names):
+        arrays[name] = rates[:, i]
+
+    # odpowiednik dropna(how="all", ...): zostaw wiersze z choć jedną wartością
+    values = np.column_stack(list(arrays.values()))
+    keep = ~np.isnan(values).all(axis=1)
+
+    out = pd.DataFrame({name: arr[keep] for name, arr in arrays.items()})
+    out.insert(0, "date", df["date"].to_numpy()[keep])
+    # wejście jest posortowane po dacie, a maska zachowuje kolejność
+    if not out["date"].is_monotonic_increasing:
+        out = out.sort_values("date", ignore_index=True)
+    return out
+
+
+def _cache_paths(cache_key: str) -> tuple[str, str, str]:
+    base = os.path.join(CACHE_DIR, cache_key)
+    return base + ".xml", base + ".etag", base + ".lastmod"
+
+
+class _IterStream:
+    """Adapter: iterator bajtów httpx → obiekt plikowy z .read() dla parsera."""
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._buf = b""
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            out = b"".join([self._buf, *self._chunks])
+            self._buf = b""
+            return out
+        while len(self._buf) < size:
+            try:
+                self._buf += next(self._chunks)
+            except StopIteration:
+                break
+        out, self._buf = self._buf[:size], self._buf[size:]
+        return out
+
+
+class _TeeReader:
+    """Czyta strumień HTTP i równolegle dopisuje go do pliku cache."""
+
+    def __init__(self, raw, cache_file):
+        self._raw = raw
+        self._cache = cache_file
+
+    def read(self, size=-1):
+        chunk = self._raw.read(size)
+        if chunk:
+            self._cache.write(chunk)
+        return chunk
+
+
+@contextmanager
+def open_xml_stream(url: str, cache_key: str, timeout: int = 30):
+    """
+    Otwiera XML spod `url` jako strumień do czytania przez parser, warunkowym
+    GET-em (If-None-Match/If-Modified-Since). Parsowanie nakłada się na
+    pobieranie — bajty idą prosto z gniazda do parsera, bez buforowania
+    całego payloadu w pamięci; po drodze trafiają też do pliku cache.
+    Gdy ECB nie opublikował nic nowego (HTTP 304), strumień czyta lokalny cache.
+    """
+    payload_path, etag_path, lastmod_path = _cache_paths(cache_key)
+
+    headers = {}
+    if os.path.exists(payload_path):
+        # walidatory wysyłamy tylko, gdy mamy payload do zwrócenia przy 304
+        if os.path.exists(etag_path):
+            with open(etag_path, encoding="utf-8") as f:
+                headers["If-None-Match"] = f.read().strip()
+        if os.path.exists(lastmod_path):
+            with open(lastmod_path, encoding="utf-8") as f:
+                headers["If-Modified-Since"] = f.read().strip()
+
+    with _CLIENT.stream("GET", url, headers=headers, timeout=timeout) as r:
+        if r.status_code == 304:
+            with open(payload_path, "rb") as f:
+                yield f
+            return
+        r.raise_for_status()
+
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        body = _IterStream(r.iter_bytes())  # iter_bytes dekoduje gzip z ECB
+        tmp_path = payload_path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as cache_f:
+                yield _TeeReader(body, cache_f)
+                # parser mógł skończyć wcześniej (daily przerywa po pierwszym
+                # dniu) — dociągnij ogon, żeby cache był kompletnym dokumentem
+                shutil.copyfileobj(body, cache_f)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        os.replace(tmp_path, payload_path)
+        if r.headers.get("ETag"):
+            with open(etag_path, "w", encoding="utf-8") as f:
+                f.write(r.headers["ETag"])
+        if r.headers.get("Last-Modified"):
+            with open(lastmod_path, "w", encoding="utf-8") as f:
+                f.write(r.headers["Last-Modified"])
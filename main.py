@@ -1,26 +1,30 @@
-import os
-import io
 import sys
 import datetime as dt
 from typing import List, Dict
-import xml.etree.ElementTree as ET
 
+import numpy as np
 import pandas as pd
-import requests
+from lxml import etree
 import plotly.graph_objs as go
 from plotly.offline import plot
 
+from etl_common import (
+    ECB_CUBE_TAG,
+    HIST_PLN,
+    HIST_RAW,
+    TARGETS,
+    compute_pln_rates,
+    ensure_dirs,
+    load_history,
+    open_xml_stream,
+    save_outputs,
+)
+
 # --- Stałe / Ścieżki ---
 ECB_DAILY_XML_URL = "https://www.ecb.europa.eu/stats/eurofxref/eurofxref-daily.xml"
 
-DATA_DIR = "data"
-HIST_RAW = os.path.join(DATA_DIR, "history_eur_base.csv")   # historia stawek ECB: 1 EUR = X [waluta]
-HIST_PLN = os.path.join(DATA_DIR, "history_pln.csv")        # historia przeliczona do PLN
 DASHBOARD_HTML = "dashboard.html"
 
-# Waluty, które pokażemy w PLN (EUR to po prostu kolumna PLN)
-TARGETS: List[str] = ["EUR", "USD", "GBP", "CHF"]
-
 # Ile dni pokazywać na wykresie (None = całość)
 CHART_LAST_N_DAYS: int | None = 365
 
@@ -31,58 +35,48 @@ def fetch_ecb_daily_xml(url: str = ECB_DAILY_XML_URL, timeout: int = 30) -> pd.D
     Pobiera eurofxref-daily.xml (1 EUR = X [waluta]) i zwraca 1-wierszowy DataFrame:
     kolumna 'date' + kolumny z walutami (USD, PLN, GBP, ...).
     """
-    r = requests.get(url, timeout=timeout)
-    r.raise_for_status()
-    tree = ET.parse(io.BytesIO(r.content))
-    root = tree.getroot()
-
-    # XML namespace bywa zmienne — weźmy wszystko po nazwie końcowej
     # Struktura: {…}Envelope/{…}Cube/{…}Cube[@time]/({…}Cube[@currency][@rate])*
-    # Szukamy elementu z atrybutem 'time'
-    ns_strip = lambda tag: tag.split("}")[-1]
+    # iterparse z filtrem na "Cube" parsuje strumieniowo w C (libxml2),
+    # prosto z gniazda — parsowanie nakłada się na pobieranie.
     date_str = None
     rates: Dict[str, float] = {}
 
-    for child in root.iter():
-        if ns_strip(child.tag) == "Cube" and "time" in child.attrib:
-            date_str = child.attrib["time"]  # YYYY-MM-DD
-            # wewnętrzne "Cube" z currency/rate
-            for n in child:
-                if ns_strip(n.tag) == "Cube" and "currency" in n.attrib and "rate" in n.attrib:
-                    ccy = n.attrib["currency"].upper()
-                    try:
-                        rates[ccy] = float(n.attrib["rate"])
-                    except ValueError:
-                        rates[ccy] = float("nan")
-            break  # mamy dzień, wychodzimy
+    # resolve_entities=False: nie rozwijamy encji z zewnętrznego XML
+    # (odpowiednik defusedxml dla lxml); parsowanie kończy się na pierwszym
+    # dniu — break przerywa iterparse zanim reszta dokumentu zostanie sparsowana
+    with open_xml_stream(url, "daily", timeout=timeout) as stream:
+        for _event, elem in etree.iterparse(
+            stream, tag=ECB_CUBE_TAG, events=("start",), resolve_entities=False
+        ):
+            time_attr = elem.get("time")
+            ccy = elem.get("currency")
+            if time_attr is not None:
+                if date_str is not None:
+                    break  # mamy już pierwszy (najnowszy) dzień
+                date_str = time_attr  # YYYY-MM-DD
+            elif ccy is not None and elem.get("rate") is not None:
+                try:
+                    rates[ccy.upper()] = float(elem.get("rate"))
+                except ValueError:
+                    rates[ccy.upper()] = float("nan")
+            # sprzątanie przetworzonych elementów — pamięć pozostaje płaska
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
 
     if not date_str:
         raise ValueError("Nie znaleziono atrybutu 'time' w eurofxref-daily.xml (brak daty).")
 
     df = pd.DataFrame([rates])
     df.insert(0, "date", pd.to_datetime(date_str, format="%Y-%m-%d"))
-    # Upewnij się, że wszystkie kolumny (poza date) są numeryczne
-    for c in df.columns:
-        if c != "date":
-            df[c] = pd.to_numeric(df[c], errors="coerce")
+    # float32 wystarcza na ≤6 cyfr znaczących ECB, a o połowę mniej bajtów
+    # płynie przez dalsze operacje kolumnowe
+    float_cols = df.columns.difference(["date"])
+    df[float_cols] = df[float_cols].astype("float32", copy=False)
     return df
 
 
-# --- Historia: wczytaj/zapisz, upsert ---
-def ensure_dirs():
-    os.makedirs(DATA_DIR, exist_ok=True)
-
-
-def load_history(path: str) -> pd.DataFrame:
-    if os.path.exists(path):
-        df = pd.read_csv(path, parse_dates=["date"])
-        # normalizacja nazw walut (upper)
-        df.columns = [c.upper() if c != "date" else "date" for c in df.columns]
-        return df.sort_values("date")
-    else:
-        return pd.DataFrame(columns=["date"]).astype({"date": "datetime64[ns]"})
-
-
+# --- Historia: upsert ---
 def upsert_daily_row(history: pd.DataFrame, today_row: pd.DataFrame) -> pd.DataFrame:
     """
     Jeśli w historii nie ma dzisiejszej daty -> dopisz wiersz z dzisiejszymi stawkami.
@@ -91,8 +85,12 @@ def upsert_daily_row(history: pd.DataFrame, today_row: pd.DataFrame) -> pd.DataF
     if today_row.empty:
         return history
 
-    d = today_row.iloc[0]["date"]
-    if history["date"].astype("datetime64[ns]").eq(d).any():
+    # historia jest posortowana — binarne wyszukanie zamiast pełnego skanu
+    # równości (i bez kopii z astype na każdym biegu)
+    d = np.datetime64(today_row["date"].iloc[0])
+    dates = history["date"].to_numpy()
+    i = dates.searchsorted(d)
+    if i < len(dates) and dates[i] == d:
         # nic nie robimy – dzisiejsza data już jest
         return history
 
@@ -101,33 +99,11 @@ def upsert_daily_row(history: pd.DataFrame, today_row: pd.DataFrame) -> pd.DataF
         if col != "date" and col not in history.columns:
             history[col] = pd.Series(dtype="float")
 
-    # dopisz
+    # dopisz; nowy wiersz to najnowsza data, więc porządek zwykle zostaje
     history = pd.concat([history, today_row[history.columns]], ignore_index=True)
-    return history.sort_values("date")
-
-
-# --- Przeliczanie na PLN ---
-def compute_pln_rates(df: pd.DataFrame, targets: List[str]) -> pd.DataFrame:
-    """
-    Z danych ECB (1 EUR = X [ccy]) tworzy tabelę kursów w PLN dla wybranych walut.
-    EUR->PLN = kolumna PLN (bo 1 EUR = X PLN).
-    USD->PLN = PLN / USD, itd.
-    """
-    if "PLN" not in df.columns:
-        raise ValueError("W danych ECB brak kolumny 'PLN' — nie policzymy przeliczeń do PLN.")
-
-    out = pd.DataFrame({"date": df["date"]})
-    if "EUR" in targets:
-        out["EUR_PLN"] = df["PLN"]
-
-    for ccy in targets:
-        if ccy in ("EUR",):
-            continue
-        if ccy not in df.columns:
-            continue
-        out[f"{ccy}_PLN"] = df["PLN"] / df[ccy]
-
-    return out.dropna(how="all", subset=[c for c in out.columns if c != "date"]).sort_values("date")
+    if not history["date"].is_monotonic_increasing:
+        history = history.sort_values("date", ignore_index=True)
+    return history
 
 
 # --- Dashboard ---
@@ -140,16 +116,19 @@ def make_dashboard(df_pln: pd.DataFrame, targets: List[str], out_html: str = DAS
             f.write(html)
         return
 
-    df_plot = df_pln.copy()
+    # bez .copy() całej historii — tniemy maską i czytamy tylko wycinek
+    df_plot = df_pln
     if last_n_days is not None:
-        cutoff = df_plot["date"].max() - pd.Timedelta(days=last_n_days)
-        df_plot = df_plot[df_plot["date"] >= cutoff]
+        cutoff = df_pln["date"].iloc[-1] - pd.Timedelta(days=last_n_days)
+        df_plot = df_pln.loc[df_pln["date"] >= cutoff]
 
+    # numpy prosto do plotly, bez konwersji Series -> lista po drodze
+    dates = df_plot["date"].to_numpy()
     traces = []
     for ccy in targets:
         col = "EUR_PLN" if ccy == "EUR" else f"{ccy}_PLN"
         if col in df_plot.columns:
-            traces.append(go.Scatter(x=df_plot["date"], y=df_plot[col], mode="lines", name=col.replace("_", " ")))
+            traces.append(go.Scatter(x=dates, y=df_plot[col].to_numpy(), mode="lines", name=col.replace("_", " ")))
 
     layout = go.Layout(
         title="FX → PLN (źródło: ECB)",
@@ -158,7 +137,15 @@ def make_dashboard(df_pln: pd.DataFrame, targets: List[str], out_html: str = DAS
         hovermode="x unified",
     )
     fig = go.Figure(data=traces, layout=layout)
-    plot(fig, filename=out_html, auto_open=False)
+    # plotly.js z CDN zamiast wklejania ~3MB bundla do każdego HTML-a
+    plot(
+        fig,
+        filename=out_html,
+        auto_open=False,
+        include_plotlyjs="cdn",
+        include_mathjax=False,
+        config={"displayModeBar": False},
+    )
 
 
 # --- Główny bieg ---
@@ -177,13 +164,13 @@ def main():
         before_rows = len(hist)
         hist = upsert_daily_row(hist, today_df)
 
-        # 4) Zapisz historię
-        hist.to_csv(HIST_RAW, index=False)
-        print(f"Historia zapisna: {HIST_RAW} (wiersze: {len(hist)}, zmiana: {len(hist)-before_rows})")
-
-        # 5) Policz kursy do PLN i zapisz
+        # 4) Policz kursy do PLN
         df_pln = compute_pln_rates(hist, TARGETS)
-        df_pln.to_csv(HIST_PLN, index=False)
+
+        # 5) Zapisz historię (tylko partycja roku nowego wiersza) i kursy PLN
+        #    jednym krokiem, równolegle
+        save_outputs(hist, df_pln, years=[int(today_df["date"].iloc[0].year)])
+        print(f"Historia zapisna: {HIST_RAW} (wiersze: {len(hist)}, zmiana: {len(hist)-before_rows})")
         print(f"Zapisano przeliczone kursy: {HIST_PLN}")
 
         # 6) Dashboard